@@ -7,30 +7,82 @@
 #
 # Requires:
 #  ffmpeg-python
+#  mutagen
 
 
 import argparse
-import datetime
+import functools
 import logging
+import mmap
+import os
+import re
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from fractions import Fraction
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Iterable, Iterator, List, Optional, Tuple
 
 import ffmpeg
 from ffmpeg import Error as FFmpegError
+from mutagen import MutagenError
+from mutagen.mp4 import MP4, MP4Cover, MP4Tags
 
 # Configure logging
 logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
 logger = logging.getLogger(__name__)
 
+# MP4 tag atoms, mapped to the names ffprobe reports them under.
+# Freeform `----:<mean>:<name>` atoms are reported under `<name>` instead.
+MP4_TAG_NAMES = {
+    '©ART': 'artist',
+    'aART': 'album_artist',
+    '©alb': 'album',
+    '©nam': 'title',
+    '©cmt': 'comment',
+    '©day': 'date',
+    '©gen': 'genre',
+    '©grp': 'grouping',
+    '©lyr': 'lyrics',
+    '©too': 'encoder',
+    '©wrt': 'composer',
+    'cprt': 'copyright',
+    'desc': 'description',
+    'ldes': 'synopsis',
+    'tvsh': 'show',
+    'tvnn': 'network',
+    'tven': 'episode_id',
+}
+
+# Extensions cover art is saved under; any existing "cover.<ext>" is assumed
+# to belong to the original files
+COVER_SUFFIXES = ('.jpg', '.png')
+
+# `FILE "<name>" <type>` line of a CUE sheet, as written and as matched
+CUE_FILE_LINE = 'FILE "{}" OGA'
+CUE_FILE_PATTERN = re.compile(rb'^FILE "(?P<name>[^"]+)" (?P<type>\w+)', re.MULTILINE)
+
 
 def main():
     """Main entry point for the m4b2oga conversion tool."""
     args = parse_arguments()
     configure_logging(args.log_level)
 
-    for input_file in args.audio_files:
-        process_audio_file(input_file.name)
+    input_paths = []
+    for input_path in args.audio_files:
+        if os.path.isfile(input_path):
+            input_paths.append(input_path)
+        else:
+            logger.error("Input file not found: %s", input_path)
+
+    if not input_paths:
+        return
+
+    # Each encode is itself multi-threaded, so only use half the cores
+    workers = min(len(input_paths), max(1, (os.cpu_count() or 2) // 2))
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=configure_logging,
+                             initargs=(args.log_level,)) as executor:
+        list(executor.map(process_audio_file, input_paths))
 
 
 def process_audio_file(input_path: str) -> None:
@@ -38,10 +90,9 @@ def process_audio_file(input_path: str) -> None:
     Process a single audio file through the conversion pipeline.
     
     Calls child-functions to process the file:
-        1. `convert_to_opus`
-        2. `extract_cover_art`
-        3. `extract_description_to_file`
-        4. `generate_cue_sheet`
+        1. `convert_to_opus`, `extract_cover_art` and `extract_description_to_file`
+           (run concurrently)
+        2. `generate_cue_sheet`
 
     Args:
         input_path: Original audio file (`m4b`)
@@ -50,55 +101,196 @@ def process_audio_file(input_path: str) -> None:
         base_path = Path(input_path)
         oga_path = base_path.with_suffix('.oga')
         cue_path = base_path.with_suffix('.cue')
-
-        if not oga_path.exists():
-            convert_to_opus(input_path, oga_path)
-
-        extract_cover_art(base_path)
-        extract_description_to_file(base_path)
-        generate_cue_sheet(input_path, oga_path, cue_path)
+        source_mtime = base_path.stat().st_mtime
+
+        # Nothing to do if a prior run already converted this version of the file.
+        # OGA and CUE files are only ever moved into place once complete, so
+        # existing ones are never left over from a failed run.
+        if is_up_to_date(oga_path, source_mtime) and any(
+                is_up_to_date(path, source_mtime) and cue_references_oga(path, oga_path.name)
+                for path in (cue_path, oga_cue_path(cue_path))):
+            logger.info("Outputs for %s are up to date, skipping", input_path)
+            return
+
+        # Start reading the file into the page cache ahead of probing and encoding
+        advise_willneed(input_path)
+
+        # Parse the tags once, shared by every metadata consumer
+        tags = read_tags(input_path)
+        tag_map = build_tag_map(input_path, tags)
+
+        # The encode dominates run time; extract the metadata files alongside it
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            jobs = [
+                executor.submit(extract_cover_art, base_path, tags),
+                executor.submit(extract_description_to_file, base_path, tag_map),
+            ]
+            if not is_up_to_date(oga_path, source_mtime):
+                jobs.append(executor.submit(convert_to_opus, input_path, oga_path))
+
+            for job in jobs:
+                job.result()
+
+        generate_cue_sheet(input_path, oga_path, cue_path, tag_map)
 
     except FFmpegError as e:
-        logger.error(f"FFmpeg error processing {input_path}: {e.stderr.decode()}")
+        logger.error("FFmpeg error processing %s: %s", input_path, e.stderr.decode())
     except Exception as e:
-        logger.error(f"Error processing {input_path}: {str(e)}", exc_info=True)
+        logger.error("Error processing %s: %s", input_path, e, exc_info=True)
+
+
+def advise_willneed(file_path: str) -> None:
+    """Hint the kernel to prefetch the whole file (no-op where unsupported)."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.debug("posix_fadvise failed for %s: %s", file_path, e)
 
 
 def convert_to_opus(input_path: str, output_path: Path) -> None:
-    """Convert input file to Opus format using FFmpeg."""
-    (
-        ffmpeg.input(input_path)
-        .output(str(output_path),
-                acodec='libopus',
-                audio_bitrate='48k',
-                map_metadata=0)
-        .overwrite_output()
-        .run()
-    )
+    """
+    Convert input file to Opus format using FFmpeg.
 
+    Several encodes may run at once, so FFmpeg is kept off the terminal:
+    stdin is not read and stderr is captured for the error handler.
 
-def get_metadata(file_path: str) -> Tuple[str, str]:
-    """Extract performer and title metadata from audio file."""
+    The encode goes to a temporary file that only replaces `output_path` once
+    FFmpeg succeeds, so a failed or interrupted run never leaves a partial OGA
+    that later runs would take as up to date.
+    """
+    temp_path = output_path.with_name(output_path.name + '.part')
     try:
-        tags = ffmpeg.probe(file_path)['format']['tags']
-        tag_map = {k.lower(): v for k, v in tags.items()}
+        (
+            ffmpeg.input(input_path)
+            .output(str(temp_path),
+                    format='oga',
+                    acodec='libopus',
+                    audio_bitrate='48k',
+                    map_metadata=0,
+                    threads=2)
+            .global_args('-nostdin')
+            .overwrite_output()
+            .run(capture_stderr=True)
+        )
+        os.replace(temp_path, output_path)
+    finally:
+        temp_path.unlink(missing_ok=True)
 
-        performer = tag_map.get('artist') or tag_map.get('performer') or ''
-        title = tag_map.get('album') or tag_map.get('title') or Path(file_path).stem
 
-        return performer, title
-    except KeyError:
-        return '', Path(file_path).stem
+def probe(file_path: str, **kwargs) -> dict:
+    """
+    Run ffprobe on the file, reusing the result of any identical earlier call.
+
+    The returned dict is shared between callers and must not be modified.
+    """
+    return _cached_probe(str(Path(file_path).absolute()), tuple(sorted(kwargs.items())))
+
+
+@functools.lru_cache(maxsize=128)
+def _cached_probe(file_path: str, options: Tuple[Tuple[str, object], ...]) -> dict:
+    return ffmpeg.probe(file_path, **dict(options))
+
+
+def read_tags(file_path: str) -> Optional[MP4Tags]:
+    """
+    Parse the MP4 tag atoms of the audio file in-process.
+
+    Returns:
+        The file's tags (empty if it has none), or `None` if it is not an MP4 container
+    """
+    try:
+        return MP4(file_path).tags or MP4Tags()
+    except MutagenError as e:
+        logger.debug("Unable to read MP4 tags from %s: %s", file_path, e)
+        return None
+
+
+def build_tag_map(file_path: str, tags: Optional[MP4Tags]) -> dict:
+    """
+    Build a lowercase tag-name to value map.
+
+    Falls back to ffprobe when the file could not be parsed as MP4.
+    """
+    if tags is None:
+        try:
+            # Same options as `get_chapters`, so both share one ffprobe run
+            probed = probe(file_path, show_chapters=None)['format'].get('tags', {})
+        except FFmpegError:
+            return {}
+        return {k.lower(): v for k, v in probed.items()}
+
+    tag_map = {}
+    for atom, values in tags.items():
+        if not values:
+            continue
+
+        if atom.startswith('----:'):
+            # Freeform values are raw bytes (`MP4FreeForm`)
+            name = atom.split(':', 2)[-1].lower()
+            value = bytes(values[0]).decode('utf-8', errors='replace')
+        else:
+            name = MP4_TAG_NAMES.get(atom)
+            value = values[0]
+
+        if name and isinstance(value, str):
+            tag_map[name] = value
+    return tag_map
+
+
+def get_metadata(file_path: str, tag_map: dict) -> Tuple[str, str]:
+    """Extract performer and title metadata from the file's `build_tag_map` result."""
+    performer = tag_map.get('artist') or tag_map.get('performer') or ''
+    title = tag_map.get('album') or tag_map.get('title') or Path(file_path).stem
+
+    return performer, title
 
 
 def get_chapters(file_path: str) -> List[dict]:
     """Retrieve chapters from media file."""
     try:
-        return ffmpeg.probe(file_path, show_chapters=None).get('chapters', [])
+        return probe(file_path, show_chapters=None).get('chapters', [])
     except FFmpegError:
         return []
 
 
+def is_up_to_date(output_path: Path, source_mtime: float) -> bool:
+    """Check that an output file exists and is no older than its source."""
+    try:
+        return output_path.stat().st_mtime >= source_mtime
+    except FileNotFoundError:
+        return False
+
+
+def oga_cue_path(cue_path: Path) -> Path:
+    """Alternate CUE path used when `cue_path` belongs to the original file."""
+    return cue_path.with_name(f"{cue_path.stem}_oga.cue")
+
+
+def cue_references_oga(cue_path: Path, oga_filename: str) -> bool:
+    """Check whether the CUE sheet at `cue_path` points at the OGA file."""
+    oga_name = oga_filename.encode('utf-8')
+
+    try:
+        with cue_path.open('rb') as f:
+            # mmap cannot map an empty file
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+
+            # Scan the mapped file directly instead of reading it into memory
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as cue_content:
+                return any(match['name'] == oga_name and match['type'] == b'OGA'
+                           for match in CUE_FILE_PATTERN.finditer(cue_content))
+    except FileNotFoundError:
+        return False
+
+
 def should_regenerate_cue(cue_path: Path, oga_path: Path) -> Tuple[bool, Path]:
     """
     Determine if we need to generate a new CUE file and which path to use.
@@ -111,22 +303,18 @@ def should_regenerate_cue(cue_path: Path, oga_path: Path) -> Tuple[bool, Path]:
     oga_filename = oga_path.name
     
     if not oga_path.exists():
-        logger.warning(f"OGA file not found at {oga_path}, forcing regeneration")
+        logger.warning("OGA file not found at %s, forcing regeneration", oga_path)
         return True, target_path
 
     try:
-        if cue_path.exists():
-            with cue_path.open('r') as f:
-                cue_content = f.read()
-                
-                # Check if existing CUE is associated with OGA file
-                if f'FILE "{oga_filename}" OGA' not in cue_content:
-                    # Create new CUE path for OGA version
-                    target_path = cue_path.with_stem(f"{cue_path.stem}_oga")
-                    logger.debug(f"Creating new CUE path: {target_path}")
-                    
-                    # Only regenerate if target doesn't exist
-                    regenerate = not target_path.exists()
+        # Check if existing CUE is associated with OGA file
+        if cue_path.exists() and not cue_references_oga(cue_path, oga_filename):
+            # Create new CUE path for OGA version
+            target_path = oga_cue_path(cue_path)
+            logger.debug("Creating new CUE path: %s", target_path)
+
+            # Only regenerate if target is missing or older than the OGA
+            regenerate = not is_up_to_date(target_path, oga_path.stat().st_mtime)
 
         return regenerate, target_path
     except FileNotFoundError:
@@ -134,9 +322,9 @@ def should_regenerate_cue(cue_path: Path, oga_path: Path) -> Tuple[bool, Path]:
         return True, target_path
 
 
-def generate_cue_sheet(m4b_path: str, oga_path: Path, cue_path: Path) -> None:
+def generate_cue_sheet(m4b_path: str, oga_path: Path, cue_path: Path, tag_map: dict) -> None:
     """Generate or update CUE sheet for the converted audio file."""
-    performer, title = get_metadata(m4b_path)
+    performer, title = get_metadata(m4b_path, tag_map)
     chapters = get_chapters(m4b_path)
 
     # Ensure OGA file exists before proceeding
@@ -146,34 +334,30 @@ def generate_cue_sheet(m4b_path: str, oga_path: Path, cue_path: Path) -> None:
     regenerate, target_cue_path = should_regenerate_cue(cue_path, oga_path)
     
     if regenerate:
-        cue_content = build_cue_content(performer, title, oga_path.name, chapters)
-        write_cue_file(target_cue_path, cue_content)
-        logger.info(f"Generated CUE sheet at {target_cue_path}")
+        cue_lines = build_cue_content(performer, title, oga_path.name, chapters)
+        write_cue_file(target_cue_path, cue_lines)
+        logger.info("Generated CUE sheet at %s", target_cue_path)
     else:
-        logger.info(f"Using existing CUE sheet at {target_cue_path}")
+        logger.info("Using existing CUE sheet at %s", target_cue_path)
 
 
-def build_cue_content(performer: str, title: str, oga_filename: str, chapters: List[dict]) -> str:
-    """Construct CUE sheet content from metadata and chapters."""
-    cue_lines = [
-        f'PERFORMER "{performer}"',
-        f'TITLE "{title}"',
-        f'FILE "{oga_filename}" OGA'
-    ]
+def build_cue_content(performer: str, title: str, oga_filename: str,
+                      chapters: List[dict]) -> Iterator[str]:
+    """Yield CUE sheet lines from metadata and chapters."""
+    yield f'PERFORMER "{performer}"'
+    yield f'TITLE "{title}"'
+    yield CUE_FILE_LINE.format(oga_filename)
 
     for idx, chapter in enumerate(chapters, start=1):
-        start_time = datetime.timedelta(seconds=float(chapter['start_time']))
-        cue_lines.extend(format_cue_entry(idx, chapter['tags']['title'], start_time))
+        # Exact start offset in CUE frames (1/75 s), from the chapter's own timebase
+        start_frames = int(chapter['start'] * Fraction(chapter['time_base']) * 75)
+        yield from format_cue_entry(idx, chapter['tags']['title'], start_frames)
 
-    return '\n'.join(cue_lines) + '\n'
 
-
-def format_cue_entry(track_number: int, title: str, start_time: datetime.timedelta) -> List[str]:
-    """Format individual CUE track entry."""
-    total_seconds = start_time.total_seconds()
-    minutes = int(total_seconds // 60)
-    seconds = int(total_seconds % 60)
-    frames = int((total_seconds - int(total_seconds)) * 75)
+def format_cue_entry(track_number: int, title: str, start_frames: int) -> List[str]:
+    """Format individual CUE track entry from its start offset in CUE frames."""
+    seconds, frames = divmod(start_frames, 75)
+    minutes, seconds = divmod(seconds, 60)
 
     return [
         f'  TRACK {track_number:02} AUDIO',
@@ -182,55 +366,143 @@ def format_cue_entry(track_number: int, title: str, start_time: datetime.timedel
     ]
 
 
-def write_cue_file(cue_path: Path, content: str) -> None:
-    """Write CUE content to file with proper error handling."""
+def write_cue_file(cue_path: Path, lines: Iterable[str]) -> None:
+    """
+    Stream CUE lines to file with proper error handling.
+
+    Lines go to a temporary file that only replaces `cue_path` once every line
+    was written, so a failure part-way never leaves a truncated sheet behind.
+    """
+    temp_path = cue_path.with_name(cue_path.name + '.part')
     try:
         cue_path.parent.mkdir(parents=True, exist_ok=True)
-        with cue_path.open('w') as f:
-            f.write(content)
+        with temp_path.open('w', encoding='utf-8') as f:
+            for line in lines:
+                f.write(line + '\n')
+        os.replace(temp_path, cue_path)
     except IOError as e:
-        logger.error(f"Failed to write CUE file: {str(e)}")
+        logger.error("Failed to write CUE file: %s", e)
+    finally:
+        temp_path.unlink(missing_ok=True)
 
 
-def extract_cover_art(base_path: Path) -> Optional[Path]:
-    """Extract embedded cover art from audio file."""
+def claim_output_path(preferred: Path, fallback: Path) -> Path:
+    """
+    Reserve `preferred` by creating it, or return `fallback` if it already exists.
 
-    cover_path = base_path.with_name('cover.jpg')
-    
-    # If "cover.jpg" already exists:
-    if cover_path.exists():
-        # Remove the extension and append "_cover.jpg"
-        cover_path = base_path.with_stem(base_path.stem + "_cover").with_suffix(".jpg")
+    Creation is atomic, so files processed in parallel never pick the same name.
+    """
+    try:
+        preferred.open('x').close()
+        return preferred
+    except FileExistsError:
+        return fallback
+
+
+def claim_cover_path(base_path: Path, suffix: str) -> Path:
+    """
+    Reserve "cover<suffix>", or return "<name>_cover<suffix>" if any cover exists.
+
+    Every "cover.<ext>" name is reserved together, in a fixed order, so two
+    files processed in parallel cannot both take an unsuffixed name.
+    """
+    fallback = base_path.with_name(f"{base_path.stem}_cover{suffix}")
+    claimed = []
+    try:
+        for cover_suffix in COVER_SUFFIXES:
+            path = base_path.with_name('cover' + cover_suffix)
+            path.open('x').close()
+            claimed.append(path)
+    except FileExistsError:
+        for path in claimed:
+            path.unlink()
+        return fallback
+
+    cover_path = base_path.with_name('cover' + suffix)
+    for path in claimed:
+        if path != cover_path:
+            path.unlink()
+    return cover_path
+
+
+def extract_cover_art(base_path: Path, tags: Optional[MP4Tags]) -> Optional[Path]:
+    """
+    Extract embedded cover art from audio file.
+
+    The `covr` atom is copied out byte-for-byte; FFmpeg is only used for
+    non-MP4 input or covers that cannot be written directly.
+    """
+    if tags is None:
+        return extract_cover_art_ffmpeg(base_path)
+
+    covers = tags.get('covr')
+    if not covers:
+        return None
+
+    try:
+        return write_cover_art(base_path, covers[0])
+    except Exception as e:
+        logger.debug("Unable to copy cover atom from %s: %s", base_path, e)
+        return extract_cover_art_ffmpeg(base_path)
+
+
+def write_cover_art(base_path: Path, cover: MP4Cover) -> Path:
+    """Write the raw image data of an MP4 cover atom to file."""
+    suffix = '.png' if cover.imageformat == MP4Cover.FORMAT_PNG else '.jpg'
+
+    # If a "cover.<ext>" already exists, use "<name>_cover.<ext>" instead
+    cover_path = claim_cover_path(base_path, suffix)
+    try:
+        cover_path.write_bytes(bytes(cover))
+    except Exception:
+        # Release a reserved "cover.<ext>" before FFmpeg picks its own name
+        if cover_path.name == 'cover' + suffix:
+            cover_path.unlink(missing_ok=True)
+        raise
+    return cover_path
+
+
+def extract_cover_art_ffmpeg(base_path: Path) -> Optional[Path]:
+    """Extract embedded cover art from audio file using FFmpeg."""
+
+    # If a "cover.<ext>" already exists, use "<name>_cover.jpg" instead
+    cover_path = claim_cover_path(base_path, '.jpg')
     
     try:
         (
             ffmpeg.input(base_path.absolute())
             .output(str(cover_path), map='0:v', vframes=1)
+            .global_args('-nostdin')
             .overwrite_output()
             .run(quiet=True)
         )
-        return cover_path if cover_path.exists() else None
+        if cover_path.exists() and cover_path.stat().st_size:
+            return cover_path
     except FFmpegError:
-        return None
+        pass
+
+    # Release the reserved "cover.jpg" so another file can use it
+    if cover_path.name == 'cover.jpg':
+        cover_path.unlink(missing_ok=True)
+    return None
 
 
-def extract_description_to_file(base_path: Path) -> Optional[Path]:
+def extract_description_to_file(base_path: Path, tag_map: dict) -> Optional[Path]:
     """Extract description metadata to text file."""
     
-    info_path = base_path.with_name('info.txt')
-    
-    # If `info.txt` already exists: 
-    if info_path.exists():
-        # Remove the extension and append "_info.txt"
-        info_path = base_path.with_stem(base_path.stem + "_info").with_suffix(".txt")
-    
     description_fields = ['description', 'comment', 'synopsis', 'summary']
 
     try:
-        tags = ffmpeg.probe(base_path.absolute())['format']['tags']
-        content = next((tags[k] for k in tags if k.lower() in description_fields), None)
+        # First non-blank field, in priority order
+        content = next((value.strip() for value in map(tag_map.get, description_fields)
+                        if value and value.strip()), None)
         
         if content:
+            # If `info.txt` already exists, use "<name>_info.txt" instead
+            info_path = claim_output_path(
+                base_path.with_name('info.txt'),
+                base_path.with_name(f"{base_path.stem}_info.txt")
+            )
             info_path.write_text(content)
             return info_path
     except Exception:
@@ -242,7 +514,7 @@ def parse_arguments():
     parser = argparse.ArgumentParser(
         description='Convert M4B audiobooks to Opus format with CUE chapters'
     )
-    parser.add_argument('audio_files', nargs='+', type=argparse.FileType('r'),
+    parser.add_argument('audio_files', nargs='+', type=str,
                        help='Input M4B file(s) to process')
     parser.add_argument('--debug', dest='log_level', action='store_const',
                        const=logging.DEBUG, default=logging.WARNING)